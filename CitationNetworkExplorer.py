@@ -1,81 +1,339 @@
 import pandas as pd
 from pybliometrics.scopus import AbstractRetrieval, AuthorRetrieval
 import networkx as nx
+import io
+import math
+import os
 import pickle
+import sqlite3
+import struct
+import threading
+import time
 import traceback
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from itertools import chain
 from pathlib import Path
 
-#from collections import Counter
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None #checkpoints are saved uncompressed without zstandard
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+EID_PREFIX = '2-s2.0-'
+
 #import matplotlib.pyplot as plt
+
+class ThinDiGraph(nx.DiGraph):
+    '''A DiGraph whose edges all share one attribute dictionary.
+    The citation graph never stores edge attributes, so this saves a dict per edge.
+    Each graph has its own shared dict, so nothing leaks between graphs.'''
+    
+    def __init__(self, incoming_graph_data=None, **attr):
+        #set before DiGraph.__init__, which may already add edges from incoming_graph_data
+        self.all_edge_dict = {}
+        super().__init__(incoming_graph_data, **attr)
+    
+    def edge_attr_dict_factory(self):
+        return self.all_edge_dict
+
+@dataclass(slots=True)
+class DocRow:
+    '''The fields of a pulled document that are actually used, read once from the pybliometrics abstract.
+    These are kept instead of the abstracts themselves, which carry all of the parsed API response.
+    authors holds (auid, indexed_name) tuples, subject_areas holds (area, abbreviation, code) tuples, 
+    and references holds the eids of the references.'''
+    eid: str
+    year: int
+    title: str
+    publication_name: str
+    citedby_count: int
+    doi: str
+    authkeywords: list
+    subject_areas: tuple
+    abstract: str
+    scopus_link: str
+    authors: tuple
+    references: tuple
+    
+    @classmethod
+    def from_abstract(cls, abstract):
+        '''Builds a DocRow from a pybliometrics AbstractRetrieval.'''
+        authors = None
+        if abstract.authors is not None:
+            authors = tuple((author.auid, author.indexed_name) for author in abstract.authors)
+        subject_areas = None
+        if abstract.subject_areas is not None:
+            subject_areas = tuple((area.area, area.abbreviation, area.code) for area in abstract.subject_areas)
+        references = None
+        if abstract.references is not None:
+            eid_from_id = CitationNetworkExplorer._eid_from_id
+            references = tuple(eid_from_id(reference.id) for reference in abstract.references)
+        return cls(
+            eid = abstract.eid,
+            year = int(abstract.coverDate[:4]),
+            title = abstract.title,
+            publication_name = abstract.publicationName,
+            citedby_count = abstract.citedby_count,
+            doi = abstract.doi,
+            authkeywords = abstract.authkeywords,
+            subject_areas = subject_areas,
+            abstract = abstract.abstract,
+            scopus_link = abstract.scopus_link,
+            authors = authors,
+            references = references
+            )
    
 class CitationNetworkExplorer:
     '''
     Pulls data from the Scopus database and manages the data pulled.
     It also generates NetworkX graphs and some pandas dataframes.
+    The citation graph uses integer node ids; citation_graph_with_eids() returns a copy labelled by eid.
     '''
 
     CHECKPOINT_DIR = Path("./CiteNetXCheckpoints/")
     CHECKPOINT_FILENAME_BASE = "checkpoint"
+    JOURNAL_SNAPSHOT_INTERVAL = 500 #journaled pulls before save_checkpoint() writes a full snapshot again
+    API_CACHE_DIRNAME = "api_cache"
+    API_CACHE_FILENAME = "retrievals.sqlite"
+    MAX_PULL_WORKERS = 8
+    MAX_REQUESTS_PER_SECOND = 9 #Scopus throttling limit for abstract retrieval
+    PROGRESS_INTERVAL = 0.5 #seconds between progress reports
     
     def __init__(self, documents = []):
+        self._doc_by_eid = {}
         self.documents = documents
         self.fails = []
         self.authorship_graph = nx.DiGraph()
-        self.citation_graph = nx.DiGraph()
+        self.citation_graph = ThinDiGraph()
+        self._eid_to_vid = {}
+        self._vid_to_eid = []
+        self._distance_cache = None
+        self._citations_version = 0
+        self._attr_index = {}
         self.target_depth = 0
         self.last_quota = ''
         self.reset_time = ''
+        self._cache_db = None
+        self._cache_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+        self._request_times = deque()
+        self._prefetch_failures = {}
+        self._journal = None
+        self._journal_key = None
+        self._journal_entries = 0
+        self._last_progress = 0.0
         
         
     def __str__(self):
         return (
-            f'{len(self.documents)} documents pulled.\n'
+            f'{len(self._doc_by_eid)} documents pulled.\n'
             f'{len(self.fails)} failed pulls.\n'
             f'{len(self.citation_graph)} total publications graphed.\n'
             f'{len(self.authorship_graph)} total nodes graphed.\n'
             f'Current target depth = {self.target_depth}.'
         )
+
+    def close(self):
+        '''Closes the checkpoint journal and the API cache connection.  
+        The instance stays usable; they are reopened as needed.'''
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = None
+        self._journal_key = None
+        self._journal_entries = 0
+        with self._cache_lock:
+            if self._cache_db is not None:
+                self._cache_db.close()
+            self._cache_db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getstate__(self):
+        '''Leaves out open files, the sqlite connection and locks, so that instances can be pickled or copied.'''
+        state = self.__dict__.copy()
+        for name in ('_journal', '_cache_db', '_cache_lock', '_rate_lock'):
+            del state[name]
+        #a copy is not attached to this instance's journal
+        state['_journal_key'] = None
+        state['_journal_entries'] = 0
+        state['_prefetch_failures'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._journal = None
+        self._cache_db = None
+        self._cache_lock = threading.Lock()
+        self._rate_lock = threading.Lock()
+
+    @property
+    def documents(self):
+        '''The documents pulled so far, as DocRows.  They are stored in a dictionary keyed on eid, 
+        so this is a list view built from that dictionary.'''
+        return list(self._doc_by_eid.values())
+
+    @documents.setter
+    def documents(self, documents):
+        #pybliometrics abstracts (e.g. from older checkpoints) are reduced to DocRows
+        self._doc_by_eid = {}
+        for doc in documents:
+            if not isinstance(doc, DocRow):
+                doc = DocRow.from_abstract(doc)
+            self._doc_by_eid[doc.eid] = doc
                   
     def _show_progress(self, place, end):
-        '''Tells the user how much of a process is complete.'''
+        '''Tells the user how much of a process is complete.
+        Reports at most once every PROGRESS_INTERVAL seconds, and always when the process completes.'''
+        now = time.monotonic()
+        if place < end and now - self._last_progress < self.PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
         progress = place/end*100
         print(f"Progress: {progress: .2f}%", end="\r")
       
-    def _eid_from_id(self, thisid):
+    @staticmethod
+    def _eid_from_id(thisid):
         '''Scopus uses both an id and an eid.  The eid is the id with a prefix added.
-        This function simply appends said prefix to a provided id and returns the eid.'''
-        eid_prefix = '2-s2.0-' 
-        return eid_prefix+thisid
+        This function simply appends said prefix to a provided id and returns the eid.
+        Ids that already have the prefix are returned unchanged.'''
+        return thisid if thisid.startswith(EID_PREFIX) else EID_PREFIX + thisid
     
+    def _vid(self, eid):
+        '''Returns the integer node id used for an eid in the citation graph, assigning a new one if needed.
+        Integer nodes are much lighter than eid strings once the graph has millions of edges.'''
+        vid = self._eid_to_vid.get(eid)
+        if vid is None:
+            vid = len(self._vid_to_eid)
+            self._eid_to_vid[eid] = vid
+            self._vid_to_eid.append(eid)
+        return vid
+
+    def citation_graph_with_eids(self):
+        '''Returns a copy of the citation graph with its nodes labelled by eid instead of integer ids.
+        The copy is an independent nx.DiGraph with its own edge attribute dicts, so it can be modified freely.'''
+        return nx.relabel_nodes(nx.DiGraph(self.citation_graph), self._vid_to_eid.__getitem__, copy=True)
+
+    def _api_cache(self):
+        '''Opens (once) the sqlite store that keeps Scopus API responses between runs, 
+        so that re-running a crawl does not spend the weekly quota again.
+        The connection is shared between threads, so callers must hold self._cache_lock.'''
+        if self._cache_db is None:
+            cache_dir = self.CHECKPOINT_DIR / self.API_CACHE_DIRNAME
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._cache_db = sqlite3.connect(cache_dir / self.API_CACHE_FILENAME, check_same_thread=False)
+            self._cache_db.execute("PRAGMA journal_mode=WAL")
+            self._cache_db.execute(
+                "CREATE TABLE IF NOT EXISTS retrievals "
+                "(kind TEXT, id TEXT, view TEXT, data BLOB, PRIMARY KEY (kind, id, view))"
+            )
+        return self._cache_db
+
+    def _cached_retrieval(self, kind, identifier, view, retrieve):
+        '''Returns the cached response for (kind, identifier, view) if there is one.  
+        Otherwise calls retrieve(), updates the quota information, and caches the result.'''
+        with self._cache_lock:
+            db = self._api_cache()
+            row = db.execute(
+                "SELECT data FROM retrievals WHERE kind=? AND id=? AND view=?", (kind, identifier, view)
+            ).fetchone()
+        if row is not None:
+            return pickle.loads(row[0])
+
+        self._throttle()
+        result = retrieve()
+        if result is not None:
+            #update quota information
+            self.last_quota = result.get_key_remaining_quota()
+            self.reset_time = result.get_key_reset_time()
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._cache_lock, db:
+                db.execute(
+                    "INSERT OR REPLACE INTO retrievals VALUES (?, ?, ?, ?)",
+                    (kind, identifier, view, data)
+                )
+        return result
+
+    def _is_cached(self, kind, identifier, view):
+        '''Returns True if the API cache already holds a response for (kind, identifier, view).'''
+        with self._cache_lock:
+            row = self._api_cache().execute(
+                "SELECT 1 FROM retrievals WHERE kind=? AND id=? AND view=?", (kind, identifier, view)
+            ).fetchone()
+        return row is not None
+
+    def _throttle(self):
+        '''Blocks until another API request fits under MAX_REQUESTS_PER_SECOND.'''
+        with self._rate_lock:
+            now = time.monotonic()
+            while self._request_times and now - self._request_times[0] >= 1:
+                self._request_times.popleft()
+            if len(self._request_times) >= self.MAX_REQUESTS_PER_SECOND:
+                time.sleep(1 - (now - self._request_times.popleft()))
+            self._request_times.append(time.monotonic())
+
+    def _quota_exhausted(self):
+        '''Returns True if the last quota information says no pulls remain this week.'''
+        try:
+            return int(self.last_quota) <= 0
+        except (TypeError, ValueError):
+            return False
+
+    def _prefetch_abstracts(self, eidlist, view='FULL'):
+        '''Retrieves the abstracts of eids that are neither pulled nor cached yet on a thread pool, 
+        so that they are in the API cache when they get processed one at a time.
+        Failures are kept in self._prefetch_failures, so the regular pull reports them without retrying.'''
+        todo = [eid for eid in dict.fromkeys(eidlist) 
+                if eid not in self._doc_by_eid and not self._is_cached('abstract', eid, view)]
+        
+        def prefetch(eid):
+            if self._quota_exhausted():
+                return
+            try:
+                self._get_abstract(eid, view)
+            except Exception as error:
+                self._prefetch_failures[eid] = error
+        
+        with ThreadPoolExecutor(max_workers=self.MAX_PULL_WORKERS) as pool:
+            for _ in pool.map(prefetch, todo):
+                pass
+
+    def _get_abstract(self, eid, view='FULL'):
+        '''AbstractRetrieval, but served from the API cache when this eid has been retrieved before.'''
+        return self._cached_retrieval('abstract', eid, view, lambda: AbstractRetrieval(eid, view=view))
+
+    def _get_author(self, auid, view='LIGHT'):
+        '''AuthorRetrieval, but served from the API cache when this auid has been retrieved before.'''
+        return self._cached_retrieval('author', str(auid), view, lambda: AuthorRetrieval(auid, view=view))
+
     #def add_citation(self, cited_by, reference):
     #    '''both args these are Elsevier EIDs'''
     #    self.citation_graph.add_edge(cited_by, reference)
         
     def is_repeat(self,eid):
         '''Checks if an eid has already been pulled in order to prevent it from being pulled again.
-        Returns True/False and the pybliometrics abstract (or None).'''
-        answer = False
-        match = None
-        
-        for doc in self.documents:
-            if doc.eid == eid:
-                answer=True
-                match = doc
-         
-        return answer, match
+        Returns True/False and the DocRow of the document (or None).'''
+        match = self._doc_by_eid.get(eid)
+        return (match is not None), match
         
     def has_documents(self):
         '''Returns True if any documents have been successfully pulled.'''
         answer = True
         
-        if len(self.documents)==0:
+        if len(self._doc_by_eid)==0:
             answer = False
             print("Do documents added.")
             
         return answer
 
-    def pull_abstract(self, eid, depth, report = False, flags={}):
+    def pull_abstract(self, eid, depth, report = False, flags=None):
         '''
         Uses the pybliometircs AbstractRetrieval Class to pull data about a document identified by its eid.  
         If depth is less than the target depth (default 0), then it will also pull data about that document's references, if
@@ -85,53 +343,51 @@ class CitationNetworkExplorer:
         If the eid has already been successfully pulled, it will not be pulled again, but depth will be checked 
            to see if its references need to be pulled.
         As part of a successful pull, 
-            1) the abstract is added to the instance's documents property, 
+            1) a DocRow of the abstract is added to the instance's documents property, 
             2) a node is added to the citation graph with any specidifed atttributes and its year of publication,
             3) an edge is added to the citation graph between the abstract and each of its references  
                 (This automatically creates a node for the reference.)
             4) an edge is added to the authorship graph between the abstract and each of its authors.
-            
+        References that need to be pulled are queued and pulled iteratively rather than recursively.
         '''
+        #a fresh queue per call, so an interrupted crawl leaves nothing behind for the next one
+        queue = deque([(eid, depth, report, flags, None)])
+        while queue:
+            self._pull_one(queue, *queue.pop())
+    
+    def _pull_one(self, queue, eid, depth, report, flags, cited_by):
+        '''Pulls a single eid for pull_abstract().  
+        cited_by is the node id of the document that referenced this eid (None for the eid pull_abstract() was given).
+        In that case the citation edge is added first, and the eid is only pulled if it has been cited often enough.
+        The queue is used as a stack, so references are pulled depth first, in the same order as a recursive crawl.'''
         min_indegree_to_pull = 3
         
-        def pull_references(abstract):
-            if abstract.references is not None:
-                #add edges to the citation network.
-                for reference in abstract.references:
-                    reference_eid = self._eid_from_id(reference.id)
-                    
-                    self.citation_graph.add_edge(abstract.eid, reference_eid)
-                    #we don't yet know anything about the reference beyond its id.  
-                    #If it gets pulled later, attributes will be associated with this node instead of creating a new one.
-                    if (depth < self.target_depth):
-                        #depending on target_depth, maybe pull references
-                        if self.citation_graph.in_degree(reference_eid) >= min_indegree_to_pull:
-                            # only pull if you've seen this document enough times.
-                            self.pull_abstract(reference_eid, depth+1)        
+        if cited_by is not None:
+            vid = self._vid(eid)
+            self.citation_graph.add_edge(cited_by, vid)
+            self._citations_version += 1
+            #len() of the predecessor dict is the in-degree, without building a degree view
+            if len(self.citation_graph.pred[vid]) < min_indegree_to_pull:
+                # only pull if you've seen this document enough times.
+                return
         
         found, match = self.is_repeat(eid)
         if found==False:
             try: 
-                abstract = AbstractRetrieval(eid, view='FULL')
+                error = self._prefetch_failures.pop(eid, None)
+                if error is not None:
+                    #this already failed while prefetching, so don't spend quota on it again
+                    raise error
+                abstract = self._get_abstract(eid)
                 if abstract is not None:
-                    #update quota information
-                    self.last_quota = abstract.get_key_remaining_quota()
-                    self.reset_time = abstract.get_key_reset_time()
-                    
-                    #add this object to the list of document objects
-                    self.documents.append(abstract)
-                    flags.update(year = abstract.coverDate[:4])
-                    self.citation_graph.add_node(abstract.eid, attr=flags)
+                    row = DocRow.from_abstract(abstract)
+                    #below the target depth, the reference edges are added as the references are popped
+                    self._add_row(row, flags, add_citations=(depth >= self.target_depth))
+                    self._journal_pull(row, flags)
                     if report == True:
                         #print out document data, if directed to do so
                         print(abstract)
-                    if abstract.authors is not None:
-                        self.authorship_graph.add_node(abstract.eid, bipartite = 0)
-                        #add edges to the authorship network
-                        for author in abstract.authors:
-                            self.authorship_graph.add_node(author.auid, bipartite = 1, name = author.indexed_name)
-                            self.authorship_graph.add_edge(abstract.eid, author.auid)
-                    pull_references(abstract)
+                    self._queue_references(queue, row, depth)
 
                                 
             except Exception:
@@ -141,22 +397,58 @@ class CitationNetworkExplorer:
                 traceback.print_exc()
         else:
             #this eid has already been successfully pulled, so we only want to check depth
-            pull_references(match)
+            self._queue_references(queue, match, depth)
+    
+    def _add_row(self, row, flags, add_citations=True):
+        '''Adds a pulled document to the documents and both graphs (steps 1-4 of pull_abstract()).
+        If add_citations is False, the edges to its references are left for _pull_one() to add.
+        This never touches the network, so it is also used to replay checkpoint journals.'''
+        #add this document to the document objects, keyed on eid
+        self._doc_by_eid[row.eid] = row
+        #flags and year are node attributes themselves, rather than one nested dict per node.
+        #Merge them without mutating the caller's flags, which every document in a batch shares
+        self._add_node(self.citation_graph, self._vid(row.eid), **{**(flags or {}), 'year': row.year})
+        if row.authors is not None:
+            self._add_node(self.authorship_graph, row.eid, bipartite = 0)
+            #add edges to the authorship network
+            for auid, indexed_name in row.authors:
+                self._add_node(self.authorship_graph, auid, bipartite = 1, name = indexed_name)
+            self.authorship_graph.add_edges_from((row.eid, auid) for auid, _ in row.authors)
+        if add_citations and row.references is not None:
+            row_vid = self._vid(row.eid)
+            #add edges to the citation network in one call.
+            #we don't yet know anything about the references beyond their ids.  
+            #If they get pulled later, attributes will be associated with these nodes instead of creating new ones.
+            self.citation_graph.add_edges_from(
+                (row_vid, self._vid(reference_eid)) for reference_eid in row.references
+            )
+            self._citations_version += 1
     
-    def pull_author(self, auid, flags={}):
+    def _queue_references(self, queue, row, depth):
+        '''Pushes the references of a document onto the pull queue if depth is below the target depth.  
+        Each one's citation edge and in-degree check wait until it is popped, as in a recursive crawl.'''
+        #depending on target_depth, maybe pull references
+        if row.references is None or depth >= self.target_depth:
+            return
+        
+        row_vid = self._vid(row.eid)
+        #reversed, so that the first reference is the next one popped
+        queue.extend((reference_eid, depth+1, False, None, row_vid) for reference_eid in reversed(row.references))
+    
+    def pull_author(self, auid, flags=None):
         '''Given an auid, pulls all of the publications of that author'''
         
         try:
-            author = AuthorRetrieval(auid, view='LIGHT')
+            author = self._get_author(auid)
             if author is not None:
                 newdocs = author.get_document_eids()
                 if newdocs is not None:
-                    self.add_documents(newdocs, flags)
+                    self.add_documents(newdocs, flags=flags)
         except Exception:
             print(auid,"failed to pull")
             traceback.print_exc()    
 
-    def pull_authors(self, auidlist, flags={}):
+    def pull_authors(self, auidlist, flags=None):
         '''pull_author(), but for a list of auids'''
         if isinstance(auidlist,str):
             auidlist = [auidlist]
@@ -165,7 +457,7 @@ class CitationNetworkExplorer:
             self.pull_author(auid, flags)
             self._show_progress(index+1,len(auidlist))       
     
-    def compile_graphs(self, filepath, target_depth = False, flags={}):
+    def compile_graphs(self, filepath, target_depth = False, flags=None):
         '''Takes a file with a list of eids and a specified depth, and 
         populates the object's properties.'''
         
@@ -174,24 +466,81 @@ class CitationNetworkExplorer:
         
         self.add_documents(outlist,target_depth, flags)
         
-    def add_document(self, eid, report = True, flags={}):
+    def add_document(self, eid, report = True, flags=None):
         '''Given an eid, pulls data about that document and adds it to the object's properties.'''
         self.pull_abstract(eid, 0, report, flags) #depth starts at zero
         
-    def add_documents(self, eidlist, target_depth = False, flags={}):
+    def add_documents(self, eidlist, target_depth = False, flags=None):
         '''add_document, but takes a list.'''
         if isinstance(eidlist, str):
             eidlist = [eidlist]
             
         self.target_depth = target_depth if target_depth else self.target_depth            
+        
+        try:
+            #network latency dominates, so fetch in parallel and only update the graphs from this thread
+            self._prefetch_abstracts(eidlist)
             
-        for index, eid in enumerate(eidlist):
-            self.add_document(eid, report=False, flags=flags)
-            self._show_progress(index+1,len(eidlist))           
+            for index, eid in enumerate(eidlist):
+                self.add_document(eid, report=False, flags=flags)
+                self._show_progress(index+1,len(eidlist))           
+        finally:
+            #prefetch failures only stand in for this batch; a later pull of the same eid should retry
+            self._prefetch_failures.clear()
        
+    def _checkpoint_path(self, key, suffix='.pickle'):
+        '''Returns the path of the checkpoint file (or its journal) for a key.'''
+        filename = f"{self.CHECKPOINT_FILENAME_BASE}{key}{suffix}"
+        return self.CHECKPOINT_DIR / filename
+    
+    def _open_journal(self, key, truncate):
+        '''Starts journaling new pulls to the journal that goes with the checkpoint for key.'''
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._checkpoint_path(key, '.journal'), 'wb' if truncate else 'ab')
+        self._journal_key = key
+        if truncate:
+            self._journal_entries = 0
+    
+    def _journal_pull(self, row, flags):
+        '''Appends a length-prefixed (eid, DocRow, flags) record for a new pull to the open journal, if any.'''
+        if self._journal is None:
+            return
+        record = pickle.dumps((row.eid, row, flags), protocol=pickle.HIGHEST_PROTOCOL)
+        self._journal.write(struct.pack('<Q', len(record)) + record)
+        self._journal.flush()
+        self._journal_entries += 1
+    
+    def _replay_journal(self, path):
+        '''Adds the pulls recorded in a checkpoint journal on top of the loaded snapshot and 
+        returns how many records it holds.  A record cut short (e.g. by a crash) is dropped from the file.'''
+        count = 0
+        with open(path, 'r+b') as f:
+            while True:
+                good_offset = f.tell()
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                (length,) = struct.unpack('<Q', header)
+                record = f.read(length)
+                if len(record) < length:
+                    break
+                eid, row, flags = pickle.loads(record)
+                #the snapshot may already include records from before it was written
+                if eid not in self._doc_by_eid:
+                    if not isinstance(row, DocRow):
+                        row = DocRow.from_abstract(row)
+                    self._add_row(row, flags)
+                count += 1
+            f.truncate(good_offset)
+        return count
+    
     def save_checkpoint(self, key=None):
         '''Pickles the accumulated data from an instance.  
-        If a key is provided, it is used in the filename.  Otherwise, the filename included a timestamp.'''
+        If a key is provided, it is used in the filename.  Otherwise, the filename included a timestamp.
+        The pickle is zstd compressed if zstandard is installed.
+        After saving, new pulls are appended to a journal next to the checkpoint.  Saving again with the 
+        same key only flushes that journal, until it holds JOURNAL_SNAPSHOT_INTERVAL pulls.'''
         # Create the directory if necessary
         self.CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
         
@@ -199,29 +548,76 @@ class CitationNetworkExplorer:
         if key is None:
             key = str(currentdatetime)
         
+        if key == self._journal_key and self._journal_entries < self.JOURNAL_SNAPSHOT_INTERVAL:
+            #the last snapshot plus its journal already hold everything
+            self._journal.flush()
+            return
+        
         save_content = dict(
             documents = self.documents, 
             authorship = self.authorship_graph, 
-            citations = self.citation_graph
+            citations = self.citation_graph,
+            citation_eids = self._vid_to_eid
             )
-        filename = f"{self.CHECKPOINT_FILENAME_BASE}{key}.pickle"
-        filepath = self.CHECKPOINT_DIR / filename
-        pickle.dump(save_content, open(filepath, 'wb'))
+        filepath = self._checkpoint_path(key)
+        #write to a temporary file first, so a crash mid-write never leaves a corrupt snapshot behind
+        temppath = self._checkpoint_path(key, '.pickle.tmp')
+        with open(temppath, 'wb') as f:
+            if zstd is not None:
+                cctx = zstd.ZstdCompressor(level=3, threads=-1)
+                with cctx.stream_writer(f, closefd=False) as z:
+                    pickle.dump(save_content, z, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                pickle.dump(save_content, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temppath, filepath)
+        #only now is the old journal covered by the snapshot
+        self._open_journal(key, truncate=True)
         
     def load_checkpoint(self, key=None):
-        '''Restores the properties from a saved checkpoint, given the appropriate key.'''
+        '''Restores the properties from a saved checkpoint, given the appropriate key.
+        Pulls journaled since the checkpoint was saved are replayed, and journaling continues from there.'''
         if key is None:
             print('key is needed to load checkpoint!')
         else:
-            filename = filename = f"{self.CHECKPOINT_FILENAME_BASE}{key}.pickle"
-            filepath = self.CHECKPOINT_DIR / filename
+            filepath = self._checkpoint_path(key)
             try:
                 with open(filepath,'rb') as f:
-                    content = pickle.load(f)
+                    compressed = f.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+                    f.seek(0)
+                    if compressed:
+                        if zstd is None:
+                            raise RuntimeError("zstandard is needed to load a compressed checkpoint")
+                        with zstd.ZstdDecompressor().stream_reader(f) as z:
+                            content = pickle.load(io.BufferedReader(z))
+                    else:
+                        content = pickle.load(f)
                 
                 self.documents = content['documents']
                 self.authorship_graph = content['authorship']
                 self.citation_graph = content['citations']
+                if 'citation_eids' in content:
+                    self._vid_to_eid = content['citation_eids']
+                else:
+                    #older checkpoints used eids as citation graph nodes
+                    self._vid_to_eid = list(self.citation_graph)
+                    self.citation_graph = ThinDiGraph(nx.convert_node_labels_to_integers(self.citation_graph))
+                self._eid_to_vid = {eid: vid for vid, eid in enumerate(self._vid_to_eid)}
+                #older checkpoints nested the flags and year in an 'attr' node attribute
+                for _, d in self.citation_graph.nodes(data=True):
+                    if isinstance(d.get('attr'), dict):
+                        d.update(d.pop('attr'))
+                    if isinstance(d.get('year'), str):
+                        d['year'] = int(d['year'])
+                self._distance_cache = None
+                self._citations_version = 0
+                self._attr_index = {}
+                
+                journal_path = self._checkpoint_path(key, '.journal')
+                replayed = self._replay_journal(journal_path) if journal_path.exists() else 0
+                self._open_journal(key, truncate=False)
+                self._journal_entries = replayed
             except Exception:
                 print("Failed to load checkpoint with key", key)
                 traceback.print_exc()
@@ -231,14 +627,15 @@ class CitationNetworkExplorer:
         subjects = []
         
         if self.has_documents():
-            for doc in self.documents:
-                if doc.subject_areas is not None:
-                    for area in doc.subject_areas:
-                        subjects.append(area)
+            counts = Counter()
+            for row in self._doc_by_eid.values():
+                if row.subject_areas is not None:
+                    counts.update(row.subject_areas)
             
-            subjects = pd.DataFrame(subjects)
-            subjects = subjects.value_counts().groupby(['area','abbreviation','code']).sum()
-            subjects.sort_values(ascending=False, inplace=True)
+            #only build pandas objects for the final counts
+            index = pd.MultiIndex.from_tuples(list(counts), names=['area','abbreviation','code'])
+            subjects = pd.Series(list(counts.values()), index=index, name='count')
+            subjects = subjects.sort_values(ascending=False).to_frame()
             
         return pd.DataFrame(subjects)
         
@@ -247,14 +644,16 @@ class CitationNetworkExplorer:
         authors = []
 
         if self.has_documents():        
-            for doc in self.documents:
-                if doc.authors is not None:
-                    authors.append(pd.DataFrame(doc.authors))
+            rows = []
+            for row in self._doc_by_eid.values():
+                if row.authors is not None:
+                    rows.extend(row.authors)
                 else:
-                    print('No authors found for ',doc.eid)
+                    print('No authors found for ',row.eid)
   
-            authors = pd.concat(authors, ignore_index=True)
-            authors = authors.value_counts().groupby(['auid','indexed_name']).sum()       
+            #build the dataframe once, from all of the documents
+            authors = pd.DataFrame(rows, columns=['auid','indexed_name'])
+            authors = authors.value_counts(sort=False).sort_index().to_frame('count')
             
         return pd.DataFrame(authors)
         
@@ -263,12 +662,11 @@ class CitationNetworkExplorer:
         years = []
         
         if self.has_documents():
-            for doc in self.documents:
-                years.append(doc.coverDate[:4])
+            years = [row.year for row in self._doc_by_eid.values()]
                 
-        years = pd.DataFrame({'year':years})
+        years = pd.Series(years, dtype='int16')
 
-        return years.value_counts().sort_index().reset_index(name='count')
+        return years.value_counts().sort_index().rename_axis('year').reset_index(name='count')
         
     def quotas(self):
         '''Reports on the most recent quota information.  The Scopus API has weekly limits.'''
@@ -287,25 +685,25 @@ class CitationNetworkExplorer:
         print(quota_string,'\n',reset_string)
         
     def doc_dataframe(self):
-        '''NOT IMPLEMENTED:
-        Returns a dataframe with certain information about the   
+        '''Returns a dataframe with certain information about the   
         documents that have been pulled.'''
         
         keep_cols = ['eid','title', 'publicationName', 'date', 'cited_by_count', 'doi', 'authkeywords', 'subject_areas', 'abstract', 'scopus_link']
+        out = []
         
-        #go through self.documents and pull out important fields
-        for doc in self.documents:
+        #go through the documents and pull out important fields
+        for row in self._doc_by_eid.values():
                 out.append([
-                    doc.eid,
-                    doc.title,
-                    doc.publicationName,
-                    doc.coverDate[:4],
-                    doc.citedby_count,
-                    doc.doi,
-                    doc.authkeywords,
-                    doc.subject_areas,
-                    doc.abstract,
-                    doc.scopus_link
+                    row.eid,
+                    row.title,
+                    row.publication_name,
+                    row.year,
+                    row.citedby_count,
+                    row.doi,
+                    row.authkeywords,
+                    row.subject_areas,
+                    row.abstract,
+                    row.scopus_link
                    ])        
         
         #build a dataframe from these fields
@@ -315,25 +713,118 @@ class CitationNetworkExplorer:
         return df
         
     def get_nodes_with_attribute(self, graph, attribute, value):
-        '''Given a graph, an attribute key and a value, returns a list of nodes that have that attribute/value pair.'''
+        '''Given a graph, an attribute key and a value, returns a list of nodes that have that attribute/value pair.
+        Nodes of the citation graph are returned as eids.'''
+        
+        selected = self._nodes_with_attribute(graph, attribute, value)
+        if graph is self.citation_graph:
+            selected = [self._vid_to_eid[n] for n in selected]
+        return selected
+
+    def _nodes_with_attribute(self, graph, attribute, value):
+        '''get_nodes_with_attribute(), but returns the graph's own node ids.
+        Nodes come back in the order the graph holds them, as a scan of the graph would return them.'''
+        index = self._attribute_index(graph, attribute)
+        if index is not None:
+            try:
+                selected = list(index.get(value, ()))
+                if graph is self.citation_graph:
+                    #citation nodes usually exist (from an edge) before their attributes are set, 
+                    #but integer ids are handed out in the order nodes join the graph
+                    selected.sort()
+                return selected
+            except TypeError:
+                pass #unhashable values are not indexed
         
         selected = []
         for n, d in graph.nodes().items():
             if attribute in d and d[attribute] == value:
                 selected.append(n)
         return selected
+    
+    def _graph_index(self, graph):
+        '''Returns the {attribute: {value: {node: None}}} index of the citation or authorship graph, 
+        or None for any other graph.  Only attributes that have been queried are in it.'''
+        if graph is self.citation_graph:
+            name = 'citations'
+        elif graph is self.authorship_graph:
+            name = 'authorship'
+        else:
+            return None
+        return self._attr_index.setdefault(name, {})
+    
+    def _attribute_index(self, graph, attribute):
+        '''Returns the {value: {node: None}} index of one attribute of the citation or authorship graph, 
+        building it on the first query for that attribute.  Returns None for any other graph.
+        The inner dicts keep the order in which nodes were given each value.'''
+        graph_index = self._graph_index(graph)
+        if graph_index is None:
+            return None
+        
+        index = graph_index.get(attribute)
+        if index is None:
+            index = {}
+            for n, d in graph.nodes().items():
+                if attribute in d:
+                    try:
+                        index.setdefault(d[attribute], {})[n] = None
+                    except TypeError:
+                        pass #unhashable values are not indexed
+            graph_index[attribute] = index
+        return index
+    
+    def _add_node(self, graph, node, **attrs):
+        '''graph.add_node(), but keeps the attributes indexed for get_nodes_with_attribute() up to date.'''
+        graph_index = self._graph_index(graph)
+        if graph_index:
+            old_attrs = graph.nodes[node] if node in graph else {}
+            for attribute, value in attrs.items():
+                index = graph_index.get(attribute)
+                if index is None:
+                    continue
+                try:
+                    if attribute in old_attrs:
+                        if old_attrs[attribute] == value:
+                            #unchanged, so keep the node where it is
+                            continue
+                        index.get(old_attrs[attribute], {}).pop(node, None)
+                    index.setdefault(value, {})[node] = None
+                except TypeError:
+                    pass #unhashable values are not indexed
+        graph.add_node(node, **attrs)
 
     def distance_from_initial_sample(self, node_id):
-        '''Given a node id, returns an integer with the length of the geodesic between that node id and 
-        the closest node that is part of the initial sample.'''
-        initial_node_ids = self.get_nodes_with_attribute(self.citation_graph, 'initial', True)
-        undirected_view = self.citation_graph.to_undirected(as_view=True)
-        distance = nx.diameter(undirected_view)
-        for initial_node_id in initial_node_ids:
-            this_distance = nx.shortest_path_length(undirected_view, source=initial_node_id, target=node_id)
-            distance = min(distance, this_distance)
+        '''Given an eid, returns an integer with the length of the geodesic between that node id and 
+        the closest node that is part of the initial sample (math.inf if there is no path).
+        Distances to every node are computed in one multi-source pass and reused until the graph changes.'''
+        initial_node_ids = self._nodes_with_attribute(self.citation_graph, 'initial', True)
+        #edges are only added by _add_row() and _pull_one(), which bump _citations_version
+        key = (frozenset(initial_node_ids), self._citations_version)
+        if self._distance_cache is None or self._distance_cache[0] != key:
+            self._distance_cache = (key, self._undirected_distances(initial_node_ids))
+            
+        vid = self._eid_to_vid.get(node_id)
+        return self._distance_cache[1].get(vid, math.inf)
             
-        return distance
+    def _undirected_distances(self, sources):
+        '''Breadth-first search of the citation graph from all sources at once, ignoring edge direction.
+        Returns a {node: distance to the closest source} dictionary.
+        Walks the successor and predecessor dicts directly, instead of going through an undirected view.'''
+        succ = self.citation_graph.succ
+        pred = self.citation_graph.pred
+        lengths = dict.fromkeys(sources, 0)
+        frontier = list(lengths)
+        distance = 0
+        while frontier:
+            distance += 1
+            next_frontier = []
+            for node in frontier:
+                for neighbor in chain(succ[node], pred[node]):
+                    if neighbor not in lengths:
+                        lengths[neighbor] = distance
+                        next_frontier.append(neighbor)
+            frontier = next_frontier
+        return lengths
             
     def suggest_adds(self, threshold=False):
         '''NOT IMPLEMENTED: